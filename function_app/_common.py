@@ -0,0 +1,237 @@
+"""Shared state and helpers for the VM and PaaS NSG tag handlers."""
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple, Type, TypeVar
+
+import azure.functions as func
+import orjson
+from azure.core.exceptions import ResourceNotFoundError
+from azure.identity.aio import DefaultAzureCredential
+from azure.mgmt.network.aio import NetworkManagementClient
+from azure.mgmt.network.models import NetworkInterface, SecurityRule, Subnet
+from azure.mgmt.resourcegraph.aio import ResourceGraphClient
+from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions
+from cachetools import TTLCache
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Single Function App shared by every handler module
+app = func.FunctionApp()
+
+# Load tag-to-NSG rule mapping configuration
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'tag-nsg-mapping.json')
+with open(CONFIG_PATH, 'rb') as f:
+    TAG_NSG_MAPPING = orjson.loads(f.read())
+
+# NIC and subnet lookups are cached per warm instance, keyed by resource ID, so
+# resources sharing a subnet don't repeat the same ARM reads on every event
+LOOKUP_CACHE_TTL_SECONDS = 60
+_NIC_CACHE = TTLCache(maxsize=1024, ttl=LOOKUP_CACHE_TTL_SECONDS)
+_SUBNET_CACHE = TTLCache(maxsize=1024, ttl=LOOKUP_CACHE_TTL_SECONDS)
+
+# Credential and SDK clients are reused across events so the managed identity
+# token cache and HTTP connection pools survive between invocations
+CREDENTIAL = DefaultAzureCredential()
+_CLIENTS: Dict[Tuple[type, str], Any] = {}
+
+# Resource Graph queries aren't scoped to a subscription, so one client serves all events
+RESOURCE_GRAPH_CLIENT = ResourceGraphClient(CREDENTIAL)
+
+
+def _build_security_rule(rule_def: Dict) -> SecurityRule:
+    """Build the SecurityRule model for a rule definition from the mapping."""
+    return SecurityRule(
+        name=rule_def['name'],
+        priority=rule_def['priority'],
+        direction=rule_def['direction'],
+        access=rule_def['access'],
+        protocol=rule_def['protocol'],
+        source_address_prefix=rule_def['source_address_prefix'],
+        destination_address_prefix=rule_def['destination_address_prefix'],
+        source_port_range=rule_def['source_port_range'],
+        destination_port_range=rule_def['destination_port_range']
+    )
+
+
+# Index NSG rules by (tag_key, tag_value) so lookups don't scan the whole mapping.
+# Each rule definition carries its prebuilt SecurityRule model under 'model', which
+# supplies both the ARM batch PUT body and the per-rule create/update fallback.
+_RULE_INDEX: Dict[Tuple[str, str], List[Dict]] = {}
+for _rule_config in TAG_NSG_MAPPING.get('rules', []):
+    _RULE_INDEX.setdefault(
+        (_rule_config.get('tag_key'), _rule_config.get('tag_value')), []
+    ).extend(
+        {**rule_def, 'model': _build_security_rule(rule_def)}
+        for rule_def in _rule_config.get('nsg_rules', [])
+    )
+
+
+class ParsedResourceId(NamedTuple):
+    """Components of an Azure resource ID."""
+    subscription_id: str
+    resource_group: str
+    provider: str
+    resource_type: str
+    resource_name: str
+
+
+def parse_resource_id(resource_id: str) -> Optional[ParsedResourceId]:
+    """
+    Parse Azure resource ID into components.
+    
+    Args:
+        resource_id: Azure resource ID string
+        
+    Returns:
+        ParsedResourceId with subscription_id, resource_group, provider, resource_type, resource_name
+        Returns None if parsing fails
+    """
+    # Resource IDs have a fixed shape:
+    # /subscriptions/<s>/resourceGroups/<rg>/providers/<provider>/<type>/<name>[/...]
+    parts = resource_id.strip('/').split('/')
+    
+    if (len(parts) < 8
+            or parts[0].lower() != 'subscriptions'
+            or parts[2].lower() != 'resourcegroups'
+            or parts[4].lower() != 'providers'):
+        log.error("Failed to parse resource ID: %s", resource_id)
+        return None
+    
+    return ParsedResourceId(
+        subscription_id=parts[1],
+        resource_group=parts[3],
+        provider=parts[5],
+        resource_type=parts[6],
+        resource_name=parts[7]
+    )
+
+
+def get_resource_id_segment(resource_id: str, key: str) -> Optional[str]:
+    """
+    Get the value following a named segment of an Azure resource ID.
+    
+    Args:
+        resource_id: Azure resource ID string
+        key: Segment name to look up (case-insensitive), e.g. 'virtualNetworks'
+        
+    Returns:
+        The segment value, or None if the key is not present
+    """
+    parts = resource_id.strip('/').split('/')
+    key = key.lower()
+    
+    for i in range(0, len(parts) - 1, 2):
+        if parts[i].lower() == key:
+            return parts[i + 1]
+    
+    return None
+
+
+def get_client(client_type: Type[T], subscription_id: str) -> T:
+    """
+    Get an Azure management client for a subscription, creating it on first use.
+    
+    Args:
+        client_type: Management client class, e.g. NetworkManagementClient
+        subscription_id: Azure subscription ID
+        
+    Returns:
+        The shared client instance
+    """
+    key = (client_type, subscription_id)
+    client = _CLIENTS.get(key)
+    if client is None:
+        client = _CLIENTS[key] = client_type(CREDENTIAL, subscription_id)
+    return client
+
+
+async def _get_cached(cache: TTLCache, resource_id: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Return a cached resource by ID, awaiting fetch() to populate the cache on a miss.
+    A 404 from fetch() evicts any stale entry before re-raising.
+    """
+    key = resource_id.lower()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    
+    try:
+        value = await fetch()
+    except ResourceNotFoundError:
+        cache.pop(key, None)
+        raise
+    
+    cache[key] = value
+    return value
+
+
+async def get_nic_cached(network_client: NetworkManagementClient, nic_id: str,
+                         resource_group: str, nic_name: str) -> NetworkInterface:
+    """Get a network interface, served from the per-instance cache when fresh."""
+    return await _get_cached(
+        _NIC_CACHE, nic_id,
+        lambda: network_client.network_interfaces.get(resource_group, nic_name)
+    )
+
+
+async def get_subnet_cached(network_client: NetworkManagementClient, subnet_id: str,
+                            resource_group: str, vnet_name: str, subnet_name: str) -> Subnet:
+    """Get a subnet, served from the per-instance cache when fresh."""
+    return await _get_cached(
+        _SUBNET_CACHE, subnet_id,
+        lambda: network_client.subnets.get(resource_group, vnet_name, subnet_name)
+    )
+
+
+def get_matching_rules(tags: Dict[str, str]) -> List[Dict]:
+    """
+    Get NSG rules that match the given resource tags.
+    
+    Args:
+        tags: Dictionary of resource tags
+        
+    Returns:
+        List of matching NSG rule definitions
+    """
+    matching_rules = []
+    
+    for tag_key, tag_value in tags.items():
+        nsg_rules = _RULE_INDEX.get((tag_key, tag_value))
+        if nsg_rules:
+            matching_rules.extend(nsg_rules)
+            log.info("Matched %s rule(s) for tag %s=%s", len(nsg_rules), tag_key, tag_value)
+    
+    return matching_rules
+
+
+async def query_resource(resource_id: str, projection: str) -> Optional[Dict[str, Any]]:
+    """
+    Read selected fields of a single resource with one Azure Resource Graph query.
+    
+    Args:
+        resource_id: Azure resource ID string
+        projection: KQL column list to project, e.g. 'tags'
+        
+    Returns:
+        The projected row, or None if the query fails or the resource isn't found
+        (callers fall back to a direct ARM read)
+    """
+    subscription_id = get_resource_id_segment(resource_id, 'subscriptions')
+    escaped_id = resource_id.replace("'", "\\'")
+    query = QueryRequest(
+        subscriptions=[subscription_id] if subscription_id else None,
+        query=f"Resources | where id =~ '{escaped_id}' | project {projection}",
+        options=QueryRequestOptions(result_format='objectArray')
+    )
+    
+    try:
+        response = await RESOURCE_GRAPH_CLIENT.resources(query)
+    except Exception as e:
+        log.warning("Resource Graph query failed for %s: %s", resource_id, e)
+        return None
+    
+    if not response.data:
+        return None
+    return response.data[0]
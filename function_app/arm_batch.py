@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from azure.core.exceptions import AzureError, HttpResponseError
+from azure.core.rest import HttpRequest
+from azure.mgmt.network.aio import NetworkManagementClient
+
+log = logging.getLogger(__name__)
+
+# ARM batch endpoint (the one the Azure Portal uses) and the Network API
+# version used for the batched security rule PUTs
+BATCH_URL = '/batch?api-version=2020-06-01'
+SECURITY_RULES_API_VERSION = '2023-05-01'
+
+# The batch endpoint accepts at most this many requests per call
+MAX_BATCH_SIZE = 20
+
+DEFAULT_POLL_INTERVAL_SECONDS = 5
+MAX_POLL_SECONDS = 600
+
+# ARM serializes writes to the child rules of one NSG, so concurrent PUTs can be
+# rejected with 409 (AnotherOperationInProgress) or 429; those are retried
+RETRYABLE_STATUS_CODES = (409, 429)
+MAX_RETRIES = 5
+
+
+def _retry_after(headers, default: int = DEFAULT_POLL_INTERVAL_SECONDS) -> int:
+    headers = {k.lower(): v for k, v in (headers or {}).items()}
+    try:
+        return int(headers.get('retry-after', default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _security_rule_url(subscription_id: str, nsg_resource_group: str, nsg_name: str, rule_name: str) -> str:
+    return (
+        f"/subscriptions/{subscription_id}/resourceGroups/{nsg_resource_group}"
+        f"/providers/Microsoft.Network/networkSecurityGroups/{nsg_name}"
+        f"/securityRules/{rule_name}?api-version={SECURITY_RULES_API_VERSION}"
+    )
+
+
+async def _send_batch(network_client: NetworkManagementClient, batch_requests: List[Dict]) -> List[Dict]:
+    """
+    POST one batch to ARM and wait for the batch itself to finish.
+
+    Args:
+        network_client: Azure Network Management client (its pipeline supplies auth and retries)
+        batch_requests: Batch request entries
+
+    Returns:
+        List of per-request batch responses
+    """
+    response = await network_client.send_request(
+        HttpRequest('POST', BATCH_URL, json={'requests': batch_requests})
+    )
+    response.raise_for_status()
+
+    # ARM answers 202 with a Location header while the batch is still running
+    deadline = time.monotonic() + MAX_POLL_SECONDS
+    while response.status_code == 202:
+        if time.monotonic() > deadline:
+            raise TimeoutError('Timed out waiting for ARM batch to complete')
+        await asyncio.sleep(_retry_after(response.headers))
+        response = await network_client.send_request(HttpRequest('GET', response.headers['Location']))
+        response.raise_for_status()
+
+    return response.json().get('responses', [])
+
+
+async def _wait_for_operation(network_client: NetworkManagementClient, response: Dict) -> None:
+    """
+    Wait for the long-running operation behind a single batch response to finish.
+
+    Raises:
+        RuntimeError: If the PUT or its async operation failed
+    """
+    status_code = response.get('httpStatusCode')
+    if status_code not in (200, 201, 202):
+        error = (response.get('content') or {}).get('error', {})
+        raise RuntimeError(f"HTTP {status_code}: {error.get('message', error)}")
+
+    headers = {k.lower(): v for k, v in (response.get('headers') or {}).items()}
+    operation_url = headers.get('azure-asyncoperation')
+    if not operation_url:
+        return
+
+    deadline = time.monotonic() + MAX_POLL_SECONDS
+    while True:
+        operation = await network_client.send_request(HttpRequest('GET', operation_url))
+        operation.raise_for_status()
+        body = operation.json()
+        status = body.get('status')
+
+        if status == 'Succeeded':
+            return
+        if status in ('Failed', 'Canceled'):
+            error = body.get('error', {})
+            raise RuntimeError(f"Operation {status}: {error.get('message', error)}")
+        if time.monotonic() > deadline:
+            raise TimeoutError('Timed out waiting for security rule operation to complete')
+
+        await asyncio.sleep(_retry_after(operation.headers))
+
+
+async def _apply_rule(network_client: NetworkManagementClient, nsg_name: str,
+                      nsg_resource_group: str, rule_def: Dict) -> None:
+    poller = await network_client.security_rules.begin_create_or_update(
+        nsg_resource_group,
+        nsg_name,
+        rule_def['name'],
+        rule_def['model']
+    )
+    await poller.result()
+
+
+async def _apply_rule_with_retry(network_client: NetworkManagementClient, nsg_name: str,
+                                 nsg_resource_group: str, rule_def: Dict, delay: int = 0) -> None:
+    """
+    Apply one rule with its own create/update call, retrying 409/429 responses.
+
+    azure-core's retry policy already retries 429 but not 409
+    AnotherOperationInProgress, which ARM returns while another write to the
+    same NSG is still running.
+
+    Args:
+        delay: Seconds to wait before the first attempt (e.g. a batch response's Retry-After)
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            await _apply_rule(network_client, nsg_name, nsg_resource_group, rule_def)
+            return
+        except HttpResponseError as e:
+            if e.status_code not in RETRYABLE_STATUS_CODES or attempt == MAX_RETRIES:
+                raise
+            delay = _retry_after(e.response.headers if e.response is not None else None)
+            log.info("Rule %s on NSG %s got HTTP %s, retrying in %ss",
+                     rule_def['name'], nsg_name, e.status_code, delay)
+
+
+def _collect_results(names: List[str], outcomes: List) -> Dict[str, Optional[str]]:
+    return {
+        name: str(outcome) if isinstance(outcome, Exception) else None
+        for name, outcome in zip(names, outcomes)
+    }
+
+
+def _rule_key(name, priority, direction, access, protocol, source_address_prefix,
+              destination_address_prefix, source_port_range, destination_port_range) -> tuple:
+    # Enum-like fields are compared case-insensitively since ARM may normalise them;
+    # the SDK returns them as enum members, so compare their values
+    direction, access, protocol = (
+        str(getattr(v, 'value', v)).lower() for v in (direction, access, protocol)
+    )
+    return (
+        name, priority, direction, access, protocol,
+        source_address_prefix, destination_address_prefix, source_port_range, destination_port_range
+    )
+
+
+async def get_changed_rules(network_client: NetworkManagementClient, nsg_name: str,
+                            nsg_resource_group: str, rules: List[Dict]) -> List[Dict]:
+    """
+    Filter out rules that already exist on the NSG with identical settings.
+
+    The NSG is read once; if that read fails every rule is returned so the
+    caller still applies them.
+
+    Args:
+        network_client: Azure Network Management client
+        nsg_name: NSG name
+        nsg_resource_group: NSG resource group
+        rules: Rule definitions from the tag mapping
+
+    Returns:
+        The rule definitions that are missing from the NSG or differ from it
+    """
+    try:
+        nsg = await network_client.network_security_groups.get(nsg_resource_group, nsg_name)
+    except Exception as e:
+        log.warning("Could not read NSG %s to diff rules, applying all: %s", nsg_name, e)
+        return rules
+
+    existing = {
+        r.name: _rule_key(
+            r.name, r.priority, r.direction, r.access, r.protocol,
+            r.source_address_prefix, r.destination_address_prefix,
+            r.source_port_range, r.destination_port_range
+        )
+        for r in nsg.security_rules or []
+    }
+
+    return [
+        rule_def for rule_def in rules
+        if existing.get(rule_def['name']) != _rule_key(
+            rule_def['name'], rule_def['priority'], rule_def['direction'], rule_def['access'],
+            rule_def['protocol'], rule_def['source_address_prefix'],
+            rule_def['destination_address_prefix'], rule_def['source_port_range'],
+            rule_def['destination_port_range']
+        )
+    ]
+
+
+async def apply_security_rules(network_client: NetworkManagementClient, subscription_id: str,
+                               nsg_name: str, nsg_resource_group: str,
+                               rules: List[Dict]) -> Dict[str, Optional[str]]:
+    """
+    Create or update security rules on an NSG using the ARM batch endpoint.
+
+    All rule PUTs are submitted in as few HTTP requests as possible and the
+    resulting operations are then awaited concurrently. Rules rejected with
+    409/429 because of a concurrent write to the NSG are resubmitted one at a
+    time. If the batch request itself fails, the rules are applied with one
+    create/update call each.
+
+    Args:
+        network_client: Azure Network Management client for the NSG's subscription
+        subscription_id: Azure subscription ID of the NSG
+        nsg_name: NSG name
+        nsg_resource_group: NSG resource group
+        rules: Rule definitions carrying a prebuilt SecurityRule under 'model', sent as the PUT body
+
+    Returns:
+        Dictionary of rule name to error message, or None if the rule applied successfully
+    """
+    if not rules:
+        return {}
+
+    try:
+        responses: Dict[str, Dict] = {}
+        for start in range(0, len(rules), MAX_BATCH_SIZE):
+            chunk = rules[start:start + MAX_BATCH_SIZE]
+            names = {str(uuid.uuid4()): rule_def['name'] for rule_def in chunk}
+            batch_requests = [
+                {
+                    'name': request_name,
+                    'httpMethod': 'PUT',
+                    'url': _security_rule_url(subscription_id, nsg_resource_group, nsg_name, rule_name),
+                    'content': rule_def['model'].as_dict()
+                }
+                for (request_name, rule_name), rule_def in zip(names.items(), chunk)
+            ]
+            for response in await _send_batch(network_client, batch_requests):
+                rule_name = names.get(response.get('name'))
+                if rule_name is None:
+                    log.warning("Ignoring unrecognised ARM batch response for NSG %s: %s",
+                                nsg_name, response.get('name'))
+                    continue
+                responses[rule_name] = response
+    except (AzureError, TimeoutError, ValueError) as e:
+        # ValueError covers a batch response body that isn't valid JSON
+        log.warning("ARM batch request failed for NSG %s, applying rules individually: %s", nsg_name, e)
+        # These PUTs still run concurrently against one NSG; conflicts are
+        # retried in _apply_rule_with_retry
+        outcomes = await asyncio.gather(
+            *(_apply_rule_with_retry(network_client, nsg_name, nsg_resource_group, rule_def)
+              for rule_def in rules),
+            return_exceptions=True
+        )
+        return _collect_results([rule_def['name'] for rule_def in rules], outcomes)
+
+    # Rules the batch rejected because of a concurrent write to the NSG are
+    # resubmitted one at a time once the rest have finished
+    rejected = [
+        rule_def for rule_def in rules
+        if responses.get(rule_def['name'], {}).get('httpStatusCode') in RETRYABLE_STATUS_CODES
+    ]
+    rejected_names = {rule_def['name'] for rule_def in rejected}
+
+    names = [
+        rule_def['name'] for rule_def in rules
+        if rule_def['name'] in responses and rule_def['name'] not in rejected_names
+    ]
+    outcomes = await asyncio.gather(
+        *(_wait_for_operation(network_client, responses[name]) for name in names),
+        return_exceptions=True
+    )
+    results = _collect_results(names, outcomes)
+
+    for rule_def in rejected:
+        try:
+            await _apply_rule_with_retry(
+                network_client, nsg_name, nsg_resource_group, rule_def,
+                delay=_retry_after(responses[rule_def['name']].get('headers'))
+            )
+            results[rule_def['name']] = None
+        except AzureError as e:
+            results[rule_def['name']] = str(e)
+
+    for rule_def in rules:
+        results.setdefault(rule_def['name'], 'No response returned in ARM batch')
+
+    return results
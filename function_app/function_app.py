@@ -1,75 +1,29 @@
-import json
 import logging
-import os
-import re
 from typing import Dict, List, Optional, Tuple
 
 import azure.functions as func
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.network import NetworkManagementClient
-from azure.mgmt.network.models import SecurityRule
+from azure.mgmt.compute.aio import ComputeManagementClient
+from azure.mgmt.compute.models import VirtualMachine
+from azure.mgmt.network.aio import NetworkManagementClient
 
-app = func.FunctionApp()
+from _common import (
+    app,
+    get_client,
+    get_matching_rules,
+    get_nic_cached,
+    get_resource_id_segment,
+    get_subnet_cached,
+    parse_resource_id,
+)
+from arm_batch import apply_security_rules, get_changed_rules
+import paas_handler  # noqa: F401 - registers the PaaS handler's trigger on the shared app
 
-# Load tag-to-NSG rule mapping configuration
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'tag-nsg-mapping.json')
-with open(CONFIG_PATH, 'r') as f:
-    TAG_NSG_MAPPING = json.load(f)
+log = logging.getLogger(__name__)
 
 
-def parse_resource_id(resource_id: str) -> Optional[Dict[str, str]]:
-    """
-    Parse Azure resource ID into components.
-    
-    Args:
-        resource_id: Azure resource ID string
-        
-    Returns:
-        Dictionary with subscription_id, resource_group, provider, resource_type, resource_name
-        Returns None if parsing fails
-    """
-    pattern = r'/subscriptions/(?P<subscription>[^/]+)/resourceGroups/(?P<resource_group>[^/]+)/providers/(?P<provider>[^/]+)/(?P<resource_type>[^/]+)/(?P<resource_name>[^/]+)'
-    match = re.match(pattern, resource_id, re.IGNORECASE)
-    
-    if not match:
-        logging.error(f"Failed to parse resource ID: {resource_id}")
-        return None
-    
-    return {
-        'subscription_id': match.group('subscription'),
-        'resource_group': match.group('resource_group'),
-        'provider': match.group('provider'),
-        'resource_type': match.group('resource_type'),
-        'resource_name': match.group('resource_name')
-    }
-
-
-def get_matching_rules(tags: Dict[str, str]) -> List[Dict]:
-    """
-    Get NSG rules that match the given VM tags.
-    
-    Args:
-        tags: Dictionary of VM tags
-        
-    Returns:
-        List of matching NSG rule definitions
-    """
-    matching_rules = []
-    
-    for rule_config in TAG_NSG_MAPPING.get('rules', []):
-        tag_key = rule_config.get('tag_key')
-        tag_value = rule_config.get('tag_value')
-        
-        if tag_key in tags and tags[tag_key] == tag_value:
-            matching_rules.extend(rule_config.get('nsg_rules', []))
-            logging.info(f"Matched {len(rule_config.get('nsg_rules', []))} rule(s) for tag {tag_key}={tag_value}")
-    
-    return matching_rules
-
-
-def get_vm_nsg(network_client: NetworkManagementClient, compute_client: ComputeManagementClient,
-               subscription_id: str, resource_group: str, vm_name: str) -> Optional[Tuple[str, str, str]]:
+async def get_vm_nsg(network_client: NetworkManagementClient, compute_client: ComputeManagementClient,
+                     subscription_id: str, resource_group: str, vm_name: str,
+                     vm: Optional[VirtualMachine] = None) -> Optional[Tuple[str, str, str]]:
     """
     Find the NSG associated with a VM (checks NIC-level first, then subnet-level).
     
@@ -79,46 +33,46 @@ def get_vm_nsg(network_client: NetworkManagementClient, compute_client: ComputeM
         subscription_id: Azure subscription ID
         resource_group: Resource group name
         vm_name: Virtual machine name
+        vm: Already-fetched VM model; fetched from Azure if not provided
         
     Returns:
         Tuple of (nsg_name, nsg_resource_group, attachment_level) or None if no NSG found
     """
     try:
         # Get the VM to find its network interfaces
-        vm = compute_client.virtual_machines.get(resource_group, vm_name)
+        if vm is None:
+            vm = await compute_client.virtual_machines.get(resource_group, vm_name)
         
         if not vm.network_profile or not vm.network_profile.network_interfaces:
-            logging.warning(f"VM {vm_name} has no network interfaces")
+            log.warning("VM %s has no network interfaces", vm_name)
             return None
         
-        # Get the primary NIC
-        primary_nic = None
-        for nic_ref in vm.network_profile.network_interfaces:
-            nic_id = nic_ref.id
-            nic_parts = parse_resource_id(nic_id)
-            if not nic_parts:
-                continue
-            
-            nic = network_client.network_interfaces.get(
-                nic_parts['resource_group'],
-                nic_parts['resource_name']
-            )
-            
-            if nic_ref.primary or len(vm.network_profile.network_interfaces) == 1:
-                primary_nic = nic
-                break
+        # Pick the primary NIC from the VM model so only that NIC is fetched
+        nic_refs = vm.network_profile.network_interfaces
+        primary_ref = next(
+            (nic_ref for nic_ref in nic_refs if nic_ref.primary),
+            nic_refs[0] if len(nic_refs) == 1 else None
+        )
+        nic_parts = parse_resource_id(primary_ref.id) if primary_ref else None
         
-        if not primary_nic:
-            logging.warning(f"No primary NIC found for VM {vm_name}")
+        if not nic_parts:
+            log.warning("No primary NIC found for VM %s", vm_name)
             return None
         
+        primary_nic = await get_nic_cached(
+            network_client,
+            primary_ref.id,
+            nic_parts.resource_group,
+            nic_parts.resource_name
+        )
+        
         # Check if NIC has an NSG attached
         if primary_nic.network_security_group:
             nsg_id = primary_nic.network_security_group.id
             nsg_parts = parse_resource_id(nsg_id)
             if nsg_parts:
-                logging.info(f"Found NIC-level NSG: {nsg_parts['resource_name']}")
-                return (nsg_parts['resource_name'], nsg_parts['resource_group'], 'nic')
+                log.info("Found NIC-level NSG: %s", nsg_parts.resource_name)
+                return (nsg_parts.resource_name, nsg_parts.resource_group, 'nic')
         
         # Check if the subnet has an NSG attached
         if primary_nic.ip_configurations:
@@ -128,86 +82,75 @@ def get_vm_nsg(network_client: NetworkManagementClient, compute_client: ComputeM
                 subnet_parts = parse_resource_id(subnet_id)
                 
                 if subnet_parts:
-                    # Get the virtual network name from the subnet ID
-                    vnet_pattern = r'/virtualNetworks/(?P<vnet_name>[^/]+)/subnets/'
-                    vnet_match = re.search(vnet_pattern, subnet_id)
+                    # Get the virtual network and subnet names from the subnet ID
+                    vnet_name = get_resource_id_segment(subnet_id, 'virtualNetworks')
+                    subnet_name = get_resource_id_segment(subnet_id, 'subnets')
                     
-                    if vnet_match:
-                        vnet_name = vnet_match.group('vnet_name')
-                        subnet = network_client.subnets.get(
-                            subnet_parts['resource_group'],
+                    if vnet_name and subnet_name:
+                        subnet = await get_subnet_cached(
+                            network_client,
+                            subnet_id,
+                            subnet_parts.resource_group,
                             vnet_name,
-                            subnet_parts['resource_name']
+                            subnet_name
                         )
                         
                         if subnet.network_security_group:
                             nsg_id = subnet.network_security_group.id
                             nsg_parts = parse_resource_id(nsg_id)
                             if nsg_parts:
-                                logging.info(f"Found subnet-level NSG: {nsg_parts['resource_name']}")
-                                return (nsg_parts['resource_name'], nsg_parts['resource_group'], 'subnet')
+                                log.info("Found subnet-level NSG: %s", nsg_parts.resource_name)
+                                return (nsg_parts.resource_name, nsg_parts.resource_group, 'subnet')
         
-        logging.warning(f"No NSG found for VM {vm_name} at NIC or subnet level")
+        log.warning("No NSG found for VM %s at NIC or subnet level", vm_name)
         return None
         
     except Exception as e:
-        logging.error(f"Error finding NSG for VM {vm_name}: {str(e)}")
+        log.error("Error finding NSG for VM %s: %s", vm_name, e)
         return None
 
 
-def apply_nsg_rules(network_client: NetworkManagementClient, nsg_name: str, 
-                   nsg_resource_group: str, rules: List[Dict]) -> bool:
+async def apply_nsg_rules(network_client: NetworkManagementClient, subscription_id: str, nsg_name: str,
+                          nsg_resource_group: str, rules: List[Dict]) -> bool:
     """
     Apply NSG rules to the specified NSG.
     
     Args:
         network_client: Azure Network Management client
+        subscription_id: Azure subscription ID of the NSG
         nsg_name: NSG name
         nsg_resource_group: NSG resource group
-        rules: List of rule definitions to apply
+        rules: List of rule definitions to apply (as returned by get_matching_rules)
         
     Returns:
         True if all rules applied successfully, False otherwise
     """
-    success = True
+    # Skip rules the NSG already has with identical settings
+    changed_rules = await get_changed_rules(network_client, nsg_name, nsg_resource_group, rules)
+    if len(changed_rules) < len(rules):
+        log.info("Skipping %s rule(s) already up to date on NSG %s", len(rules) - len(changed_rules), nsg_name)
+    if not changed_rules:
+        return True
     
-    for rule_def in rules:
-        try:
-            security_rule = SecurityRule(
-                name=rule_def['name'],
-                priority=rule_def['priority'],
-                direction=rule_def['direction'],
-                access=rule_def['access'],
-                protocol=rule_def['protocol'],
-                source_address_prefix=rule_def['source_address_prefix'],
-                destination_address_prefix=rule_def['destination_address_prefix'],
-                source_port_range=rule_def['source_port_range'],
-                destination_port_range=rule_def['destination_port_range']
-            )
-            
-            logging.info(f"Applying NSG rule {rule_def['name']} to NSG {nsg_name}")
-            
-            # Use begin_create_or_update for idempotent operation
-            poller = network_client.security_rules.begin_create_or_update(
-                nsg_resource_group,
-                nsg_name,
-                rule_def['name'],
-                security_rule
-            )
-            
-            # Wait for the operation to complete
-            result = poller.result()
-            logging.info(f"Successfully applied rule {rule_def['name']} to NSG {nsg_name}")
-            
-        except Exception as e:
-            logging.error(f"Failed to apply rule {rule_def['name']} to NSG {nsg_name}: {str(e)}")
+    for rule_def in changed_rules:
+        log.info("Applying NSG rule %s to NSG %s", rule_def['name'], nsg_name)
+    
+    # Submit all rule PUTs through the ARM batch endpoint and wait for them together
+    results = await apply_security_rules(network_client, subscription_id, nsg_name, nsg_resource_group, changed_rules)
+    
+    success = True
+    for rule_name, error in results.items():
+        if error is None:
+            log.info("Successfully applied rule %s to NSG %s", rule_name, nsg_name)
+        else:
+            log.error("Failed to apply rule %s to NSG %s: %s", rule_name, nsg_name, error)
             success = False
     
     return success
 
 
 @app.event_grid_trigger(arg_name="event")
-def nsg_tag_handler(event: func.EventGridEvent):
+async def nsg_tag_handler(event: func.EventGridEvent):
     """
     Azure Function triggered by Event Grid events.
     Processes VM create/update events and applies NSG rules based on tags.
@@ -216,69 +159,70 @@ def nsg_tag_handler(event: func.EventGridEvent):
         event: Event Grid event
     """
     try:
-        logging.info(f"Processing Event Grid event: {event.id}")
-        logging.info(f"Event type: {event.event_type}")
-        logging.info(f"Subject: {event.subject}")
+        log.info("Processing Event Grid event: %s", event.id)
+        log.info("Event type: %s", event.event_type)
+        log.info("Subject: %s", event.subject)
         
         # Parse the resource ID from the event subject
         resource_id = event.subject
         parsed_id = parse_resource_id(resource_id)
         
         if not parsed_id:
-            logging.error(f"Could not parse resource ID from event subject: {resource_id}")
+            log.error("Could not parse resource ID from event subject: %s", resource_id)
             return
         
         # Only process Virtual Machine events
-        if parsed_id['resource_type'].lower() != 'virtualmachines':
-            logging.info(f"Skipping non-VM resource: {parsed_id['resource_type']}")
+        if parsed_id.resource_type.lower() != 'virtualmachines':
+            log.info("Skipping non-VM resource: %s", parsed_id.resource_type)
             return
         
-        subscription_id = parsed_id['subscription_id']
-        resource_group = parsed_id['resource_group']
-        vm_name = parsed_id['resource_name']
+        subscription_id = parsed_id.subscription_id
+        resource_group = parsed_id.resource_group
+        vm_name = parsed_id.resource_name
         
-        logging.info(f"Processing VM: {vm_name} in resource group: {resource_group}")
+        log.info("Processing VM: %s in resource group: %s", vm_name, resource_group)
         
         # Initialize Azure SDK clients with Managed Identity
-        credential = DefaultAzureCredential()
-        compute_client = ComputeManagementClient(credential, subscription_id)
-        network_client = NetworkManagementClient(credential, subscription_id)
+        compute_client = get_client(ComputeManagementClient, subscription_id)
+        network_client = get_client(NetworkManagementClient, subscription_id)
         
-        # Get the VM to read its tags
+        # Get the VM to read its tags. This is read from ARM directly rather than
+        # Resource Graph, whose index can still hold the pre-change tags when a
+        # tag-update event arrives.
         try:
-            vm = compute_client.virtual_machines.get(resource_group, vm_name)
+            vm = await compute_client.virtual_machines.get(resource_group, vm_name)
             tags = vm.tags or {}
-            logging.info(f"VM tags: {tags}")
+            log.info("VM tags: %s", tags)
         except Exception as e:
-            logging.error(f"Failed to get VM {vm_name}: {str(e)}")
+            log.error("Failed to get VM %s: %s", vm_name, e)
             return
         
         # Get matching NSG rules based on tags
         matching_rules = get_matching_rules(tags)
         
         if not matching_rules:
-            logging.info(f"No matching NSG rules found for VM {vm_name} tags")
+            log.info("No matching NSG rules found for VM %s tags", vm_name)
             return
         
-        logging.info(f"Found {len(matching_rules)} matching rules for VM {vm_name}")
+        log.info("Found %s matching rules for VM %s", len(matching_rules), vm_name)
         
         # Find the NSG associated with the VM
-        nsg_info = get_vm_nsg(network_client, compute_client, subscription_id, resource_group, vm_name)
+        nsg_info = await get_vm_nsg(network_client, compute_client, subscription_id, resource_group, vm_name, vm=vm)
         
         if not nsg_info:
-            logging.warning(f"No NSG found for VM {vm_name}. Cannot apply rules.")
+            log.warning("No NSG found for VM %s. Cannot apply rules.", vm_name)
             return
         
         nsg_name, nsg_resource_group, attachment_level = nsg_info
-        logging.info(f"Applying rules to {attachment_level}-level NSG: {nsg_name}")
+        log.info("Applying rules to %s-level NSG: %s", attachment_level, nsg_name)
         
         # Apply the NSG rules
-        success = apply_nsg_rules(network_client, nsg_name, nsg_resource_group, matching_rules)
+        success = await apply_nsg_rules(network_client, subscription_id, nsg_name, nsg_resource_group, matching_rules)
         
         if success:
-            logging.info(f"Successfully processed VM {vm_name} and applied all NSG rules")
+            log.info("Successfully processed VM %s and applied all NSG rules", vm_name)
         else:
-            logging.warning(f"Completed processing VM {vm_name} but some rules failed to apply")
+            log.warning("Completed processing VM %s but some rules failed to apply", vm_name)
         
     except Exception as e:
-        logging.error(f"Error processing event {event.id}: {str(e)}", exc_info=True)
+        log.error("Error processing event %s: %s", event.id, e, exc_info=True)
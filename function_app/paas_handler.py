@@ -1,73 +1,66 @@
-import json
+import asyncio
 import logging
-import os
 import azure.functions as func
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.network import NetworkManagementClient
-from azure.mgmt.network.models import SecurityRule
-from azure.mgmt.resource import ResourceManagementClient
+from azure.mgmt.network.aio import NetworkManagementClient
+from azure.mgmt.resource.resources.aio import ResourceManagementClient
 
-app = func.FunctionApp()
+from _common import (
+    app,
+    get_client,
+    get_matching_rules,
+    get_nic_cached,
+    get_resource_id_segment,
+    get_subnet_cached,
+    parse_resource_id,
+    query_resource,
+)
+from arm_batch import apply_security_rules, get_changed_rules
 
-RULE_MAPPING_PATH = os.path.join(os.path.dirname(__file__), "tag-nsg-mapping.json")
-with open(RULE_MAPPING_PATH, "r") as f:
-    RULE_MAPPING = json.load(f)
-
-
-def parse_resource_id(resource_id: str) -> dict:
-    parts = resource_id.strip("/").split("/")
-    parsed = {}
-    for i in range(0, len(parts) - 1, 2):
-        parsed[parts[i]] = parts[i + 1]
-    return parsed
-
-
-def get_matching_rules(tags: dict) -> list:
-    matched = []
-    for rule_def in RULE_MAPPING.get("rules", []):
-        tag_key = rule_def["tag_key"]
-        tag_value = rule_def["tag_value"]
-        if tags.get(tag_key) == tag_value:
-            matched.extend(rule_def["nsg_rules"])
-    return matched
+log = logging.getLogger(__name__)
 
 
 @app.function_name(name="PaasNsgTagHandler")
 @app.event_grid_trigger(arg_name="event")
-def paas_nsg_tag_handler(event: func.EventGridEvent):
+async def paas_nsg_tag_handler(event: func.EventGridEvent):
     """
     Triggered when a Private Endpoint is created or updated.
     Reads tags from the parent PaaS resource and applies
     matching NSG rules to the Private Endpoint's subnet NSG.
     """
-    logging.info(f"Event received: {event.id}, type: {event.event_type}")
+    log.info("Event received: %s, type: %s", event.id, event.event_type)
+
+    # Only process Private Endpoint events. The subject is the resource ID,
+    # so irrelevant events are dropped before the payload is deserialized.
+    # ARM doesn't guarantee the casing of provider/type segments, so compare
+    # case-insensitively.
+    if "/providers/microsoft.network/privateendpoints/" not in (event.subject or "").lower():
+        log.info("Skipping non-PE resource: %s", event.subject)
+        return
 
     data = event.get_json()
-    resource_id = data.get("resourceUri", "")
-
-    # Only process Private Endpoint events
-    if "Microsoft.Network/privateEndpoints" not in resource_id:
-        logging.info(f"Skipping non-PE resource: {resource_id}")
-        return
+    resource_id = data.get("resourceUri") or event.subject
 
     parsed = parse_resource_id(resource_id)
-    subscription_id = parsed.get("subscriptions")
-    resource_group = parsed.get("resourceGroups")
-    pe_name = parsed.get("privateEndpoints")
+    if not parsed:
+        log.error("Could not parse resource ID: %s", resource_id)
+        return
 
-    if not all([subscription_id, resource_group, pe_name]):
-        logging.error(f"Could not parse resource ID: {resource_id}")
+    if (parsed.provider.lower() != "microsoft.network"
+            or parsed.resource_type.lower() != "privateendpoints"):
+        log.info("Skipping non-PE resource: %s", resource_id)
         return
 
-    credential = DefaultAzureCredential()
-    network_client = NetworkManagementClient(credential, subscription_id)
-    resource_client = ResourceManagementClient(credential, subscription_id)
+    subscription_id = parsed.subscription_id
+    resource_group = parsed.resource_group
+    pe_name = parsed.resource_name
+
+    network_client = get_client(NetworkManagementClient, subscription_id)
 
     # 1. Get the Private Endpoint
     try:
-        pe = network_client.private_endpoints.get(resource_group, pe_name)
+        pe = await network_client.private_endpoints.get(resource_group, pe_name)
     except Exception as e:
-        logging.error(f"Failed to get Private Endpoint '{pe_name}': {e}")
+        log.error("Failed to get Private Endpoint '%s': %s", pe_name, e)
         return
 
     # 2. Get the parent PaaS resource and its tags
@@ -78,129 +71,161 @@ def paas_nsg_tag_handler(event: func.EventGridEvent):
             pe.private_link_service_connections[0]
             .private_link_service_id
         )
-        # Try multiple API versions for broader compatibility
-        api_versions = ["2023-01-01", "2022-09-01", "2021-04-01"]
-        for api_version in api_versions:
-            try:
-                parent_resource = resource_client.resources.get_by_id(
-                    linked_resource_id, api_version=api_version
-                )
-                tags = parent_resource.tags or {}
-                logging.info(
-                    f"Parent PaaS resource tags: {tags} "
-                    f"(from {linked_resource_id}, API version: {api_version})"
-                )
-                break  # Success, exit the loop
-            except Exception as e:
-                if api_version == api_versions[-1]:
-                    # Last attempt failed
-                    logging.warning(
-                        f"Could not read parent resource tags with any API version: {e}. "
-                        f"Falling back to PE tags."
+        # Resource Graph uses a unified schema, so one query reads the tags
+        # without having to negotiate the parent resource's API version
+        row = await query_resource(linked_resource_id, "tags")
+        if row is not None:
+            tags = row.get("tags") or {}
+            log.info(
+                "Parent PaaS resource tags: %s "
+                "(from %s, via Resource Graph)",
+                tags, linked_resource_id
+            )
+        else:
+            # Try multiple API versions for broader compatibility
+            resource_client = get_client(ResourceManagementClient, subscription_id)
+            api_versions = ["2023-01-01", "2022-09-01", "2021-04-01"]
+            for api_version in api_versions:
+                try:
+                    parent_resource = await resource_client.resources.get_by_id(
+                        linked_resource_id, api_version=api_version
+                    )
+                    tags = parent_resource.tags or {}
+                    log.info(
+                        "Parent PaaS resource tags: %s "
+                        "(from %s, API version: %s)",
+                        tags, linked_resource_id, api_version
                     )
-                    tags = pe.tags or {}
-                # Otherwise, try next API version
+                    break  # Success, exit the loop
+                except Exception as e:
+                    if api_version == api_versions[-1]:
+                        # Last attempt failed
+                        log.warning(
+                            "Could not read parent resource tags with any API version: %s. "
+                            "Falling back to PE tags.",
+                            e
+                        )
+                        tags = pe.tags or {}
+                    # Otherwise, try next API version
     else:
         tags = pe.tags or {}
 
     # 3. Determine matching NSG rules
     rules_to_apply = get_matching_rules(tags)
     if not rules_to_apply:
-        logging.info(f"No matching NSG rules for PE '{pe_name}' tags.")
+        log.info("No matching NSG rules for PE '%s' tags.", pe_name)
         return
 
     # 4. Find the PE's subnet and its NSG
     if not pe.network_interfaces:
-        logging.warning(
-            f"Private Endpoint '{pe_name}' has no network interfaces. "
-            f"Cannot apply NSG rules."
+        log.warning(
+            "Private Endpoint '%s' has no network interfaces. "
+            "Cannot apply NSG rules.",
+            pe_name
         )
         return
     
-    for nic_ref in pe.network_interfaces:
-        nic_parsed = parse_resource_id(nic_ref.id)
-        nic_name = nic_parsed.get("networkInterfaces")
-        nic_rg = nic_parsed.get("resourceGroups")
+    async def get_nic(nic_ref):
+        nic_name = get_resource_id_segment(nic_ref.id, "networkInterfaces")
+        nic_rg = get_resource_id_segment(nic_ref.id, "resourceGroups")
+        try:
+            return await get_nic_cached(
+                network_client, nic_ref.id, nic_rg, nic_name
+            )
+        except Exception as e:
+            log.error(
+                "Failed to get NIC '%s' in resource group "
+                "'%s': %s",
+                nic_name, nic_rg, e
+            )
+            return None
 
+    async def get_subnet(subnet_id):
+        vnet_name = get_resource_id_segment(subnet_id, "virtualNetworks")
+        subnet_name = get_resource_id_segment(subnet_id, "subnets")
+        subnet_rg = get_resource_id_segment(subnet_id, "resourceGroups")
         try:
-            nic = network_client.network_interfaces.get(nic_rg, nic_name)
+            return await get_subnet_cached(
+                network_client, subnet_id, subnet_rg, vnet_name, subnet_name
+            )
         except Exception as e:
-            logging.error(
-                f"Failed to get NIC '{nic_name}' in resource group "
-                f"'{nic_rg}': {e}"
+            log.error(
+                "Failed to get subnet '%s' in VNet "
+                "'%s': %s",
+                subnet_name, vnet_name, e
             )
+            return None
+
+    # The NIC and subnet lookups are independent reads, so fetch them
+    # concurrently rather than one round trip at a time.
+    nics = await asyncio.gather(*(get_nic(nic_ref) for nic_ref in pe.network_interfaces))
+
+    subnet_ids = []
+    for nic in nics:
+        if nic is None:
             continue
 
         if not nic.ip_configurations:
-            logging.warning(
-                f"NIC '{nic_name}' has no IP configurations. Skipping."
+            log.warning(
+                "NIC '%s' has no IP configurations. Skipping.", nic.name
             )
             continue
 
         for ip_config in nic.ip_configurations:
             if not ip_config.subnet:
-                logging.warning(
-                    f"IP configuration has no subnet for PE '{pe_name}'. Skipping."
-                )
-                continue
-            
-            subnet_id = ip_config.subnet.id
-            subnet_parsed = parse_resource_id(subnet_id)
-            vnet_name = subnet_parsed.get("virtualNetworks")
-            subnet_name = subnet_parsed.get("subnets")
-            subnet_rg = subnet_parsed.get("resourceGroups")
-
-            try:
-                subnet = network_client.subnets.get(
-                    subnet_rg, vnet_name, subnet_name
-                )
-            except Exception as e:
-                logging.error(
-                    f"Failed to get subnet '{subnet_name}' in VNet "
-                    f"'{vnet_name}': {e}"
+                log.warning(
+                    "IP configuration has no subnet for PE '%s'. Skipping.", pe_name
                 )
                 continue
+            # Several IP configurations can share a subnet; look it up once
+            if ip_config.subnet.id not in subnet_ids:
+                subnet_ids.append(ip_config.subnet.id)
 
-            if not subnet.network_security_group:
-                logging.warning(
-                    f"No NSG on subnet '{subnet_name}' for PE "
-                    f"'{pe_name}'. Skipping."
-                )
-                continue
+    subnets = await asyncio.gather(*(get_subnet(subnet_id) for subnet_id in subnet_ids))
 
-            nsg_parsed = parse_resource_id(
-                subnet.network_security_group.id
+    for subnet in subnets:
+        if subnet is None:
+            continue
+
+        if not subnet.network_security_group:
+            log.warning(
+                "No NSG on subnet '%s' for PE "
+                "'%s'. Skipping.",
+                subnet.name, pe_name
             )
-            nsg_name = nsg_parsed.get("networkSecurityGroups")
-            nsg_rg = nsg_parsed.get("resourceGroups")
-
-            # 5. Apply matching rules to the subnet NSG
-            for rule in rules_to_apply:
-                security_rule = SecurityRule(
-                    protocol=rule["protocol"],
-                    source_address_prefix=rule["source_address_prefix"],
-                    destination_address_prefix=rule[
-                        "destination_address_prefix"
-                    ],
-                    source_port_range=rule["source_port_range"],
-                    destination_port_range=rule["destination_port_range"],
-                    access=rule["access"],
-                    priority=rule["priority"],
-                    direction=rule["direction"],
+            continue
+
+        nsg_id = subnet.network_security_group.id
+        nsg_name = get_resource_id_segment(nsg_id, "networkSecurityGroups")
+        nsg_rg = get_resource_id_segment(nsg_id, "resourceGroups")
+
+        # 5. Apply matching rules the subnet NSG doesn't already have,
+        #    in one ARM batch
+        changed_rules = await get_changed_rules(
+            network_client, nsg_name, nsg_rg, rules_to_apply
+        )
+        if len(changed_rules) < len(rules_to_apply):
+            log.info(
+                "Skipping %s rule(s) "
+                "already up to date on NSG '%s'.",
+                len(rules_to_apply) - len(changed_rules), nsg_name
+            )
+        if not changed_rules:
+            continue
+
+        results = await apply_security_rules(
+            network_client, subscription_id, nsg_name, nsg_rg, changed_rules
+        )
+        for rule_name, error in results.items():
+            if error is None:
+                log.info(
+                    "Applied rule '%s' to subnet NSG "
+                    "'%s' for PE '%s'.",
+                    rule_name, nsg_name, pe_name
+                )
+            else:
+                log.error(
+                    "Failed to apply rule '%s' to "
+                    "NSG '%s': %s",
+                    rule_name, nsg_name, error
                 )
-                try:
-                    network_client.security_rules.begin_create_or_update(
-                        nsg_rg,
-                        nsg_name,
-                        rule["name"],
-                        security_rule,
-                    ).result()
-                    logging.info(
-                        f"Applied rule '{rule['name']}' to subnet NSG "
-                        f"'{nsg_name}' for PE '{pe_name}'."
-                    )
-                except Exception as e:
-                    logging.error(
-                        f"Failed to apply rule '{rule['name']}' to "
-                        f"NSG '{nsg_name}': {e}"
-                    )
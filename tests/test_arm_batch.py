@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'function_app'))
+
+from azure.mgmt.network.models import NetworkSecurityGroup  # noqa: E402
+
+from arm_batch import get_changed_rules  # noqa: E402
+
+RULE = {
+    'name': 'Allow-Finance-Subnet',
+    'priority': 200,
+    'direction': 'Inbound',
+    'access': 'Allow',
+    'protocol': 'Tcp',
+    'source_address_prefix': '10.10.20.0/24',
+    'destination_port_range': '443',
+    'destination_address_prefix': '*',
+    'source_port_range': '*'
+}
+
+
+def _nsg(priority: int) -> NetworkSecurityGroup:
+    return NetworkSecurityGroup({
+        'properties': {
+            'securityRules': [{
+                'name': RULE['name'],
+                'properties': {
+                    'priority': priority,
+                    'direction': 'Inbound',
+                    'access': 'Allow',
+                    'protocol': 'Tcp',
+                    'sourceAddressPrefix': RULE['source_address_prefix'],
+                    'destinationAddressPrefix': RULE['destination_address_prefix'],
+                    'sourcePortRange': RULE['source_port_range'],
+                    'destinationPortRange': RULE['destination_port_range']
+                }
+            }]
+        }
+    })
+
+
+class GetChangedRulesTest(unittest.IsolatedAsyncioTestCase):
+
+    async def _changed(self, nsg: NetworkSecurityGroup):
+        client = mock.MagicMock()
+        client.network_security_groups.get = mock.AsyncMock(return_value=nsg)
+        return await get_changed_rules(client, 'nsg', 'rg', [RULE])
+
+    async def test_identical_rule_is_skipped(self):
+        self.assertEqual(await self._changed(_nsg(RULE['priority'])), [])
+
+    async def test_differing_rule_is_returned(self):
+        self.assertEqual(await self._changed(_nsg(RULE['priority'] + 1)), [RULE])
+
+
+if __name__ == '__main__':
+    unittest.main()